@@ -1,14 +1,11 @@
-import codecs
-import json
-import base64
-import mutagen
-import mutagen.mp4
-import mutagen.id3
+import concurrent.futures
+import functools
+import mmap
 import os
 import platform
 import subprocess
 import sys
-import re
+import threading
 
 stemDescription  = 'stem-meta'
 stemOutExtension = ".m4a"
@@ -19,12 +16,94 @@ _linux = platform.system() == "Linux"
 _supported_files_no_conversion = [".m4a", ".mp4", ".m4p"]
 _supported_files_conversion = [".wav", ".wave", ".aif", ".aiff", ".flac"]
 
+_pngSignature = b"\x89PNG\r\n\x1a\n"
+
+# orjson is used when it is installed, the standard library otherwise. Both variants work on UTF-8 encoded
+# bytes: _loads accepts bytes or str, _dumps returns compact bytes.
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# https://picard-docs.musicbrainz.org/en/appendices/tag_mapping.html
+# http://www.jthink.net/jaudiotagger/tagmapping.html
+# https://mutagen.readthedocs.io/en/latest/api/mp4.html
+#
+# (tag name in the tags file, MP4 atom, kind), applied in order: when several tags map to the same atom
+# (e.g. "organization", "publisher" and "label"), the last one present wins.
+# kind is None for plain values, "int" for integer lists, "freeform" for iTunes freeform atoms and an
+# AtomDataType name for freeform atoms with a specific data type.
+_tagMap = [
+    ("title"                   , "\xa9nam"                                        , None),
+    ("artist"                  , "\xa9ART"                                        , None),
+    ("release"                 , "\xa9alb"                                        , None),
+    ("album_artist"            , "aART"                                           , None),
+    ("remixer"                 , "----:com.apple.iTunes:REMIXER"                  , "freeform"),
+    ("mix"                     , "----:com.apple.iTunes:MIXER"                    , "freeform"),
+    ("producer"                , "----:com.apple.iTunes:PRODUCER"                 , "freeform"),
+    ("organization"            , "----:com.apple.iTunes:LABEL"                    , "freeform"),
+    ("publisher"               , "----:com.apple.iTunes:LABEL"                    , "freeform"),
+    ("label"                   , "----:com.apple.iTunes:LABEL"                    , "freeform"),
+    ("genre"                   , "\xa9gen"                                        , None),
+    ("style"                   , "\xa9gen"                                        , None),
+    ("catalog_no"              , "----:com.apple.iTunes:CATALOGNUMBER"            , "freeform"),
+    ("year"                    , "\xa9day"                                        , None),
+    ("date"                    , "\xa9day"                                        , None),
+    ("isrc"                    , "----:com.apple.iTunes:ISRC"                     , "ISRC"),
+    ("upc"                     , "----:com.apple.iTunes:BARCODE"                  , "UPC"),
+    ("barcode"                 , "----:com.apple.iTunes:BARCODE"                  , "UPC"),
+    ("description"             , "ldes"                                           , None),
+    ("comment"                 , "\xa9cmt"                                        , None),
+    ("bpm"                     , "tmpo"                                           , "int"),
+    ("initialkey"              , "----:com.apple.iTunes:initialkey"               , "freeform"),
+    ("key"                     , "----:com.apple.iTunes:KEY"                      , "freeform"),
+    ("album"                   , "\xa9alb"                                        , None),
+    ("mood"                    , "----:com.apple.iTunes:MOOD"                     , "freeform"),
+    ("grouping"                , "\xa9grp"                                        , None),
+    ("composer"                , "\xa9wrt"                                        , None),
+    ("lyrics"                  , "\xa9lyr"                                        , None),
+    ("copyright"               , "cprt"                                           , None),
+    ("url_discogs_artist_site" , "----:com.apple.iTunes:URL_DISCOGS_ARTIST_SITE"  , "freeform"),
+    ("www"                     , "----:com.apple.iTunes:URL_DISCOGS_RELEASE_SITE" , "freeform"),
+    ("url_discogs_release_site", "----:com.apple.iTunes:URL_DISCOGS_RELEASE_SITE" , "freeform"),
+    ("youtube_id"              , "----:com.apple.iTunes:YouTube Id"               , "freeform"),
+    ("beatport_id"             , "----:com.apple.iTunes:Beatport Id"              , "freeform"),
+    ("qobuz_id"                , "----:com.apple.iTunes:Qobuz Id"                 , "freeform"),
+    ("discogs_release_id"      , "----:com.apple.iTunes:Discogs Id"               , "freeform"),
+    ("media"                   , "----:com.apple.iTunes:MEDIA"                    , "freeform"),
+    ("country"                 , "----:com.apple.iTunes:COUNTRY"                  , "freeform"),
+]
+
 def _removeFile(path):
-    if os.path.lexists(path):
-        if os.path.isfile(path):
-            os.remove(path)
-        else:
+    # A single unlink: missing files are fine, directories are refused
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except IsADirectoryError:
+        raise RuntimeError("Cannot remove " + path + ": not a file")
+    except PermissionError:
+        # macOS and Windows report EPERM/EACCES instead of EISDIR for directories
+        if os.path.isdir(path):
             raise RuntimeError("Cannot remove " + path + ": not a file")
+        raise
+
+_progressLock = threading.Lock()
+
+def _progress(message):
+    # stderr is unbuffered, so each message is a single write. The lock keeps messages from the conversion
+    # threads started in StemCreator.save from interleaving.
+    with _progressLock:
+        sys.stderr.write(message + "\n")
+        sys.stderr.flush()
 
 def _getProgramPath():
     folderPath = os.path.dirname(os.path.realpath(__file__))
@@ -34,6 +113,7 @@ def _getProgramPath():
         folderPath = os.path.dirname(folderPath)
     return folderPath
 
+@functools.lru_cache(maxsize=None)
 def _findCmd(cmd):
     try:
         from shutil import which
@@ -45,19 +125,34 @@ def _findCmd(cmd):
                 return path
     return None
 
+# Resolved once per process: these do not change while stems are being created.
+_programPath = _getProgramPath()
+_ffmpeg      = _findCmd("ffmpeg")
+_ffprobe     = _findCmd("ffprobe")
+_qaac        = (_findCmd("qaac64") or _findCmd("qaac32") or _findCmd("qaac")) if _windows else None
+_mp4box      = _findCmd("MP4Box") if _linux else os.path.join(_programPath,
+                                                              "GPAC_win"   if _windows else "GPAC_mac",
+                                                              "mp4box.exe" if _windows else "MP4Box")
+
+@functools.lru_cache(maxsize=None)
 def _checkAvailableAacEncoders():
-    output = subprocess.check_output([_findCmd("ffmpeg"), "-v", "error", "-codecs"])
-    aac_codecs = [
-        x for x in
-        output.splitlines() if "AAC (Advanced Audio Coding)" in str(x)
-    ][0]
-    hay = aac_codecs.decode('ascii')
-    match = re.findall(r'\(encoders: ([^\)]*) \)', hay)
-    if match:
-        return match[0].split(" ")
-    else:
+    output = subprocess.check_output([_ffmpeg, "-v", "error", "-codecs"])
+    # Search the raw output directly, the encoders are listed on the AAC line only
+    line = output.find(b"AAC (Advanced Audio Coding)")
+    if line < 0:
         return None
+    lineEnd = output.find(b"\n", line)
+    if lineEnd < 0:
+        lineEnd = len(output)
+    start = output.find(b"(encoders:", line, lineEnd)
+    if start < 0:
+        return None
+    end = output.find(b")", start, lineEnd)
+    if end < 0:
+        return None
+    return output[start + len(b"(encoders:"):end].decode('ascii').split()
 
+@functools.lru_cache(maxsize=None)
 def _getAacCodec():
     avail = _checkAvailableAacEncoders()
     if avail is not None:
@@ -66,7 +161,7 @@ def _getAacCodec():
         elif 'libfdk_aac' in avail:
             codec = 'libfdk_aac'
         else:
-            print("For better audio quality, install `aac_at` or `libfdk_aac` codec.")
+            _progress("For better audio quality, install `aac_at` or `libfdk_aac` codec.")
             codec = 'aac'
     else:
         codec = 'aac'
@@ -74,8 +169,69 @@ def _getAacCodec():
     return codec
 
 def _getSampleRate(trackPath):
-    output = subprocess.check_output([_findCmd("ffprobe"), "-v", "error", "-select_streams", "a", "-show_entries", "stream=sample_rate", "-of", "default=noprint_wrappers=1:nokey=1", trackPath])
-    return int(output)
+    # Keyed on the modification time so that a track rewritten in between is probed again
+    return _probeSampleRate(trackPath, os.path.getmtime(trackPath))
+
+@functools.lru_cache(maxsize=None)
+def _probeSampleRate(trackPath, mtime):
+    output = subprocess.check_output([_ffprobe, "-v", "error", "-select_streams", "a", "-show_entries", "stream=sample_rate", "-of", "json", trackPath])
+    return int(_loads(output)["streams"][0]["sample_rate"])
+
+def _probeAllSampleRates(trackPaths):
+    # ffprobe is I/O-bound, so threads are enough to run the probes concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(trackPaths), 1)) as executor:
+        return dict(zip(trackPaths, executor.map(_getSampleRate, trackPaths)))
+
+# Encoder arguments, the input and output paths are added around them in _convertToFormat.
+# Several ffmpeg processes run at once: they must not read the terminal, and only report errors.
+_ffmpegArgs   = ("-nostdin", "-hide_banner", "-loglevel", "error")
+_alacArgs     = ("-c:a", "alac", "-c:v", "copy")
+_aacArgs      = ("-c:a", "aac", "-c:v", "copy")
+_aacCodecArgs = {
+    "aac_at"    : ("-c:a", "aac_at", "-q:a", "0", "-c:v", "copy"),
+    "libfdk_aac": ("-c:a", "libfdk_aac", "-vbr", "5", "-c:v", "copy"),
+}
+_resampleArgs = ("-ar", "48000")
+_qaacArgs     = ("--tvbr", "127", "-o")
+
+# Seconds StemCreator.save waits for further conversions to finish before muxing the ones that are ready
+_muxBatchDelay = 2.0
+
+def _convertToFormat(trackPath, format, aacCodec, sampleRate):
+    trackName, fileExtension = os.path.splitext(trackPath)
+
+    if fileExtension in _supported_files_no_conversion:
+        return trackPath
+
+    if fileExtension in _supported_files_conversion:
+        _progress("\nconverting " + trackPath + " to " + format + "...")
+
+        newPath = trackName + ".m4a"
+        _removeFile(newPath)
+
+        if format == "aac" and _qaac is not None:
+            # Use QAAC on Windows if installed
+            _progress("using QAAC Audio Toolbox codec")
+            converterArgs = [_qaac, trackPath, *_qaacArgs, newPath]
+        elif format == "aac":
+            _progress("using " + aacCodec + " codec")
+
+            # If the sample rate is superior to 48kHz, we need to downsample to 48kHz
+            resampleArgs = ()
+            if sampleRate > 48000:
+                _progress(str(sampleRate) + "Hz sample rate, downsampling to 48kHz")
+                resampleArgs = _resampleArgs
+
+            converterArgs = [_ffmpeg, *_ffmpegArgs, "-i", trackPath, *_aacCodecArgs.get(aacCodec, _aacArgs), *resampleArgs, newPath]
+        else:
+            converterArgs = [_ffmpeg, *_ffmpegArgs, "-i", trackPath, *_alacArgs, newPath]
+
+        subprocess.check_call(converterArgs, stdin=subprocess.DEVNULL)
+        return newPath
+    else:
+        print("invalid input file format \"" + fileExtension + "\"")
+        print("valid input file formats are " + ", ".join(_supported_files_conversion))
+        sys.exit()
 
 class StemCreator:
 
@@ -90,26 +246,24 @@ class StemCreator:
         self._mixdownTrack = mixdownTrack
         self._stemTracks   = stemTracks
         self._format       = fileFormat if fileFormat else "alac"
-        self._tags         = json.load(open(tags)) if tags else {}
+        self._tags         = {}
+        if tags:
+            with open(tags, "rb") as fileObj:
+                self._tags = _loads(fileObj.read())
 
         # Mutagen complains gravely if we do not explicitly convert the tag values to a
         # particular encoding. We chose UTF-8, others would work as well.
         # for key, value in self._tags.iteritems(): self._tags[key] = repr(value).encode('utf-8')
 
-        metaData = []
+        metaData = {}
         if metadataFile:
-            fileObj = codecs.open(metadataFile, encoding="utf-8")
-            try:
-                metaData = json.load(fileObj)
-            except IOError:
-                raise
-            except Exception as e:
-                raise RuntimeError("Error while reading metadata file")
-            finally:
-                fileObj.close()
-
-        numStems       = len(stemTracks)
-        numMetaEntries = len(metaData["stems"])
+            with open(metadataFile, "rb") as fileObj:
+                try:
+                    metaData = _loads(fileObj.read())
+                except IOError:
+                    raise
+                except Exception as e:
+                    raise RuntimeError("Error while reading metadata file")
 
         self._metadata = metaData
 
@@ -117,73 +271,19 @@ class StemCreator:
         # entries. If even those are not enough, we pad the remaining entries with the following default value:
         # {"name" : "Stem_${TRACK#}", "color" : "#000000"}
 
-        if numStems > numMetaEntries:
-            print("missing stem metadata for stems " + str(numMetaEntries) + " - " + str(numStems))
-            numDefaultEntries = len(self._defaultMetadata)
-            self._metadata.extend(self._defaultMetadata["stems"][numMetaEntries:min(numStems, numDefaultEntries)])
-            self._metadata["stems"].extend([{"name" :"".join(["Stem_", str(i + numDefaultEntries)]), "color" : "#000000"} \
-                for i in range(numStems - numDefaultEntries)])
-
-    def _convertToFormat(self, trackPath, format):
-        trackName, fileExtension = os.path.splitext(trackPath)
-
-        if fileExtension in _supported_files_no_conversion:
-            return trackPath
+        stems    = self._metadata.setdefault("stems", [])
+        numStems = len(stemTracks)
 
-        if fileExtension in _supported_files_conversion:
-            print("\nconverting " + trackPath + " to " + self._format + "...")
-            sys.stdout.flush()
-
-            newPath = trackName + ".m4a"
-            _removeFile(newPath)
-
-            converter = "ffmpeg"
-            converterArgs = [converter]
-
-            if self._format == "aac":
-                # AAC
-                if _windows and (_findCmd("qaac64") is not None or _findCmd("qaac32") is not None or _findCmd("qaac") is not None):
-                    # Use QAAC on Windows if installed
-                    qaac = _findCmd("qaac64") if not None else _findCmd("qaac32") if not None else _findCmd("qaac")
-                    print("using QAAC Audio Toolbox codec")
-
-                    converterArgs = [qaac]
-                    converterArgs.extend([trackPath])
-                    converterArgs.extend(["--tvbr", "127"])
-                    converterArgs.extend(["-o"])
-                else:
-                    aacCodec = _getAacCodec()
-                    sampleRate = _getSampleRate(trackPath)
-
-                    print("using " + aacCodec + " codec")
-
-                    converterArgs.extend(["-i"  , trackPath])
-                    converterArgs.extend(["-c:a", aacCodec])
-                    if aacCodec == 'aac_at':
-                        converterArgs.extend(["-q:a", "0"])
-                    elif aacCodec == 'libfdk_aac':
-                        converterArgs.extend(["-vbr", "5"])
-                        # converterArgs.extend(["-cutoff", "20000"])
-                    converterArgs.extend(["-c:v", "copy"])
-                    # If the sample rate is superior to 48kHz, we need to downsample to 48kHz
-                    if sampleRate > 48000:
-                        print(str(sampleRate) + "Hz sample rate, downsampling to 48kHz")
-                        converterArgs.extend(["-ar", "48000"])
-            else:
-                # ALAC
-                converterArgs.extend(["-i"  , trackPath])
-                converterArgs.extend(["-c:a", "alac"])
-                converterArgs.extend(["-c:v", "copy"])
-
-            converterArgs.extend([newPath])
-            subprocess.check_call(converterArgs)
-            return newPath
-        else:
-            print("invalid input file format \"" + fileExtension + "\"")
-            print("valid input file formats are " + ", ".join(_supported_files_conversion))
-            sys.exit()
+        if numStems > len(stems):
+            print("missing stem metadata for stems " + str(len(stems)) + " - " + str(numStems))
+            stems.extend(self._defaultMetadata[len(stems):numStems])
+            stems.extend([{"name" : f"Stem_{i}", "color" : "#000000"} for i in range(len(stems) + 1, numStems + 1)])
 
     def save(self, outputFilePath = None):
+        # Imported here rather than at module level: StemMetadataViewer does not need them
+        import base64
+        from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm, AtomDataType
+
         # When using mp4box, in order to get a playable file, the initial file
         # extension has to be .m4a -> this gets renamed at the end of the method.
         if not outputFilePath:
@@ -193,211 +293,196 @@ class StemCreator:
             root, ext = os.path.splitext(outputFilePath)
 
         outputFilePath = "".join([root, stemOutExtension])
-        _removeFile(outputFilePath)
 
-        folderName = "GPAC_win"   if _windows else "GPAC_mac"
-        executable = "mp4box.exe" if _windows else "MP4Box"
-        mp4box     = _findCmd(executable) if _linux else os.path.join(_getProgramPath(), folderName, executable)
+        _progress("\n[Done 0/6]\n")
         
-        print("\n[Done 0/6]\n")
-        sys.stdout.flush()
-        
-        callArgs = [mp4box]
-        callArgs.extend(["-add", self._convertToFormat(self._mixdownTrack, format) + "#ID=Z", outputFilePath])
-        print("\n[Done 1/6]\n")
-        sys.stdout.flush()
-        conversionCounter = 1
-        for stemTrack in self._stemTracks:
-            callArgs.extend(["-add", self._convertToFormat(stemTrack, format) + "#ID=Z:disable"])
-            conversionCounter += 1
-            print("\n[Done " + str(conversionCounter) + "/6]\n")
-            sys.stdout.flush()
-
-        metadata = json.dumps(self._metadata)
-        metadata = base64.b64encode(metadata.encode("utf-8"))
-        metadata = "0:type=stem:src=base64," + metadata.decode("utf-8")
-        callArgs.extend(["-udta", metadata])
-        subprocess.check_call(callArgs)
-        sys.stdout.flush()
-
-        # https://picard-docs.musicbrainz.org/en/appendices/tag_mapping.html
-        # http://www.jthink.net/jaudiotagger/tagmapping.html
-        # https://mutagen.readthedocs.io/en/latest/api/mp4.html
-
-        tags = mutagen.mp4.Open(outputFilePath)
-        # name
-        if ("title" in self._tags):
-            tags["\xa9nam"] = self._tags["title"]
-        # artist
-        if ("artist" in self._tags):
-            tags["\xa9ART"] = self._tags["artist"]
-        # album
-        if ("release" in self._tags):
-            tags["\xa9alb"] = self._tags["release"]
-        # album artist
-        if ("album_artist" in self._tags):
-            tags["aART"] = self._tags["album_artist"]
-        # remixer
-        if ("remixer" in self._tags):
-            tags["----:com.apple.iTunes:REMIXER"] = mutagen.mp4.MP4FreeForm(self._tags["remixer"].encode("utf-8"))
-        # mix
-        if ("mix" in self._tags):
-            tags["----:com.apple.iTunes:MIXER"] = mutagen.mp4.MP4FreeForm(self._tags["mix"].encode("utf-8"))
-        # producer
-        if ("producer" in self._tags):
-            tags["----:com.apple.iTunes:PRODUCER"] = mutagen.mp4.MP4FreeForm(self._tags["producer"].encode("utf-8"))
-        # label
-        if ("organization" in self._tags):
-            tags["----:com.apple.iTunes:LABEL"] = mutagen.mp4.MP4FreeForm(self._tags["organization"].encode("utf-8"))
-        if ("publisher" in self._tags):
-            tags["----:com.apple.iTunes:LABEL"] = mutagen.mp4.MP4FreeForm(self._tags["publisher"].encode("utf-8"))
-        if ("label" in self._tags):
-            tags["----:com.apple.iTunes:LABEL"] = mutagen.mp4.MP4FreeForm(self._tags["label"].encode("utf-8"))
-        # genre
-        if ("genre" in self._tags):
-            tags["\xa9gen"] = self._tags["genre"]
-        if ("style" in self._tags):
-            tags["\xa9gen"] = self._tags["style"]
-        # trkn
-        if ("track" in self._tags):
-            if ("track_count" in self._tags):
-                tags["trkn"] = self._tags["track"]
-        if ("track_no" in self._tags):
-            if ("track_count" in self._tags):
+        # The mixdown and the stems are converted by independent ffmpeg processes, so we run them in parallel.
+        # The workers only wait on their ffmpeg child, so threads are enough.
+        # Results are collected by index to keep the mixdown first and the stems in their original order.
+        tracks         = [self._mixdownTrack] + list(self._stemTracks)
+        convertedPaths = [None] * len(tracks)
+        maxWorkers     = min(len(tracks), os.cpu_count() or 1)
+        sampleRates    = {}
+        aacCodec       = None
+        if self._format == "aac" and _qaac is None:
+            # Only the ffmpeg AAC path needs the codec and the sample rates: resolve the codec once rather than in
+            # every conversion worker, and probe every track that will be converted up front
+            aacCodec    = _getAacCodec()
+            sampleRates = _probeAllSampleRates(
+                list(dict.fromkeys(track for track in tracks if os.path.splitext(track)[1] in _supported_files_conversion)))
+
+        # Compact JSON keeps the base64 payload (and the mp4box command line) short
+        metadata = b"0:type=stem:src=base64," + base64.b64encode(_dumps(self._metadata))
+
+        # Conversions are keyed on the file they write: tracks that point to the same file (e.g. the same stem
+        # passed twice) are only converted once, and two different sources must not write the same file
+        # concurrently (e.g. "drums.wav" and "drums.flac" both convert to "drums.m4a").
+        targets = []
+        sources = {}
+        for track in tracks:
+            source          = os.path.realpath(track)
+            sourceRoot, ext = os.path.splitext(source)
+            target          = os.path.normcase(source if ext in _supported_files_no_conversion else sourceRoot + ".m4a")
+            if sources.setdefault(target, source) != source:
+                raise RuntimeError("Cannot use both " + sources[target] + " and " + source + ": they convert to the same file")
+            targets.append(target)
+
+        # The stem is built next to the output and only replaces it once it is complete, so a failed run neither
+        # leaves a partial stem behind nor destroys an existing one
+        partialPath = root + ".partial" + stemOutExtension
+        _removeFile(partialPath)
+        conversions = {}
+        futures     = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                try:
+                    for i, (track, target) in enumerate(zip(tracks, targets)):
+                        if target not in conversions:
+                            conversions[target] = executor.submit(_convertToFormat, track, self._format, aacCodec, sampleRates.get(track))
+                        futures.setdefault(conversions[target], []).append(i)
+                    conversionCounter = 0
+                    numMuxed          = 0
+                    pending           = set(futures)
+                    while pending:
+                        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        # Every mp4box call rewrites the whole output file. Conversions of similar length finish close to
+                        # each other, so give the remaining ones a moment to be muxed in the same call.
+                        if pending:
+                            moreDone, pending = concurrent.futures.wait(pending, timeout=_muxBatchDelay)
+                            done |= moreDone
+                        for future in done:
+                            for i in futures[future]:
+                                convertedPaths[i] = future.result()
+                                conversionCounter += 1
+                                _progress("\n[Done " + str(conversionCounter) + "/6]\n")
+
+                        # mp4box adds tracks to an existing output file, so the tracks that are ready are muxed while the
+                        # remaining conversions keep running. Tracks are only added in order: the mixdown has to be the
+                        # first track, followed by the stems.
+                        numReady = numMuxed
+                        while numReady < len(tracks) and convertedPaths[numReady] is not None:
+                            numReady += 1
+                        if numReady == numMuxed:
+                            continue
+
+                        callArgs = [_mp4box]
+                        for i in range(numMuxed, numReady):
+                            callArgs.extend(["-add", convertedPaths[i] + ("#ID=Z" if i == 0 else "#ID=Z:disable")])
+                        if numReady == len(tracks):
+                            callArgs.extend(["-udta", metadata.decode("ascii")])
+                        callArgs.append(partialPath)
+                        subprocess.check_call(callArgs)
+                        numMuxed = numReady
+                except BaseException:
+                    # Conversions that have not started yet are dropped, so leaving the with block only waits for the
+                    # ffmpeg processes that are already running
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
+            tags = MP4(partialPath)
+            for tagName, atomName, kind in _tagMap:
+                if tagName not in self._tags:
+                    continue
+                value = self._tags[tagName]
+                if kind is None:
+                    tags[atomName] = value
+                elif kind == "int":
+                    tags[atomName] = [int(value)]
+                elif kind == "freeform":
+                    tags[atomName] = MP4FreeForm(str(value).encode("utf-8"))
+                else:
+                    tags[atomName] = MP4FreeForm(str(value).encode("utf-8"), getattr(AtomDataType, kind))
+            # trkn: "track_no" is the track number (ID3 TRCK)
+            if ("track_no" in self._tags) and ("track_count" in self._tags):
                 tags["trkn"] = [(int(self._tags["track_no"]), int(self._tags["track_count"]))]
-        # catalog number
-        if ("catalog_no" in self._tags):
-            tags["----:com.apple.iTunes:CATALOGNUMBER"] = mutagen.mp4.MP4FreeForm(self._tags["catalog_no"].encode("utf-8"))
-        # date
-        if ("year" in self._tags):
-            tags["\xa9day"] = self._tags["year"]
-        if ("date" in self._tags):
-            tags["\xa9day"] = self._tags["date"]
-        # isrc
-        if ("isrc" in self._tags):
-            tags["----:com.apple.iTunes:ISRC"] = mutagen.mp4.MP4FreeForm(self._tags["isrc"].encode("utf-8"), mutagen.mp4.AtomDataType.ISRC)
-        # barcode
-        if ("upc" in self._tags):
-            tags["----:com.apple.iTunes:BARCODE"] = mutagen.mp4.MP4FreeForm(str(self._tags["upc"]).encode("utf-8"), mutagen.mp4.AtomDataType.UPC)
-        # cover
-        if ("cover" in self._tags):
-            coverPath = self._tags["cover"]
-            with open(coverPath, "rb") as f:
-                coverData = f.read()
-            tags["covr"] = [mutagen.mp4.MP4Cover(coverData,
-              mutagen.mp4.MP4Cover.FORMAT_PNG if coverPath.endswith('png') else
-              mutagen.mp4.MP4Cover.FORMAT_JPEG
-            )]
-        # description (long description)
-        if ("description" in self._tags):
-            tags["ldes"] = self._tags["description"]
-        # comment
-        if ("comment" in self._tags):
-            tags["\xa9cmt"] = self._tags["comment"]
-        # bpm
-        if ("bpm" in self._tags):
-            tags["tmpo"] = [int(self._tags["bpm"])]
-        # initial key
-        if ("initialkey" in self._tags):
-            tags["----:com.apple.iTunes:initialkey"] = mutagen.mp4.MP4FreeForm(self._tags["initialkey"].encode("utf-8"))
-        # key
-        if ("key" in self._tags):
-            tags["----:com.apple.iTunes:KEY"] = mutagen.mp4.MP4FreeForm(self._tags["key"].encode("utf-8"))
-        # album
-        if ("album" in self._tags):
-            tags["\xa9alb"] = self._tags["album"]
-        # mood
-        if ("mood" in self._tags):
-            tags["----:com.apple.iTunes:MOOD"] = mutagen.mp4.MP4FreeForm(self._tags["mood"].encode("utf-8"))
-        # grouping
-        if ("grouping" in self._tags):
-            tags["\xa9grp"] = self._tags["grouping"]
-        # composer
-        if ("composer" in self._tags):
-            tags["\xa9wrt"] = self._tags["composer"]
-        # barcode
-        if ("barcode" in self._tags):
-            tags["----:com.apple.iTunes:BARCODE"] = mutagen.mp4.MP4FreeForm(str(self._tags["barcode"]).encode("utf-8"), mutagen.mp4.AtomDataType.UPC)
-        # lyrics
-        if ("lyrics" in self._tags):
-            tags["\xa9lyr"] = self._tags["lyrics"]
-        # copyright
-        if ("copyright" in self._tags):
-            tags["cprt"] = self._tags["copyright"]
-        # url_discogs_artist_site
-        if ("url_discogs_artist_site" in self._tags):
-            tags["----:com.apple.iTunes:URL_DISCOGS_ARTIST_SITE"] = mutagen.mp4.MP4FreeForm(self._tags["url_discogs_artist_site"].encode("utf-8"))
-        # url_discogs_release_site
-        if ("www" in self._tags):
-            tags["----:com.apple.iTunes:URL_DISCOGS_RELEASE_SITE"] = mutagen.mp4.MP4FreeForm(self._tags["www"].encode("utf-8"))
-        if ("url_discogs_release_site" in self._tags):
-            tags["----:com.apple.iTunes:URL_DISCOGS_RELEASE_SITE"] = mutagen.mp4.MP4FreeForm(self._tags["url_discogs_release_site"].encode("utf-8"))
-        # youtube_id
-        if ("youtube_id" in self._tags):
-            tags["----:com.apple.iTunes:YouTube Id"] = mutagen.mp4.MP4FreeForm(self._tags["youtube_id"].encode("utf-8"))
-        # beatport_id
-        if ("beatport_id" in self._tags):
-            tags["----:com.apple.iTunes:Beatport Id"] = mutagen.mp4.MP4FreeForm(self._tags["beatport_id"].encode("utf-8"))
-        # qobuz_id
-        if ("qobuz_id" in self._tags):
-            tags["----:com.apple.iTunes:Qobuz Id"] = mutagen.mp4.MP4FreeForm(self._tags["qobuz_id"].encode("utf-8"))
-        # discogs_id
-        if ("discogs_release_id" in self._tags):
-            tags["----:com.apple.iTunes:Discogs Id"] = mutagen.mp4.MP4FreeForm(self._tags["discogs_release_id"].encode("utf-8"))
-        # media
-        if ("media" in self._tags):
-            tags["----:com.apple.iTunes:MEDIA"] = mutagen.mp4.MP4FreeForm(self._tags["media"].encode("utf-8"))
-        # country
-        if ("country" in self._tags):
-            tags["----:com.apple.iTunes:COUNTRY"] = mutagen.mp4.MP4FreeForm(self._tags["country"].encode("utf-8"))
-
-        tags["TAUT"] = "STEM"
-        tags.save(outputFilePath)
+            # disk: "track" is the disc position (ID3 TPOS), "1" or "1/2"
+            if ("track" in self._tags):
+                discNumber, _, discCount = str(self._tags["track"]).partition("/")
+                if discNumber.strip().isdigit() and (not discCount.strip() or discCount.strip().isdigit()):
+                    tags["disk"] = [(int(discNumber), int(discCount or 0))]
+            # cover
+            if ("cover" in self._tags):
+                # MP4Cover copies straight out of the mapping, so the image is not read into an intermediate buffer
+                # first. The format is detected from the file signature rather than from the extension.
+                # An empty file (e.g. a failed cover extraction) cannot be mapped and is read as-is instead.
+                with open(self._tags["cover"], "rb") as f:
+                    if os.fstat(f.fileno()).st_size:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as coverData:
+                            cover = MP4Cover(coverData, MP4Cover.FORMAT_PNG if coverData[:8] == _pngSignature else
+                                                        MP4Cover.FORMAT_JPEG)
+                    else:
+                        cover = MP4Cover(f.read(), MP4Cover.FORMAT_JPEG)
+                tags["covr"] = [cover]
+
+            tags["TAUT"] = "STEM"
+            tags.save(partialPath)
+            os.replace(partialPath, outputFilePath)
+        finally:
+            # The converted tracks are only needed by mp4box, so we do not leave them next to the sources. This also
+            # runs on failure, for every conversion that was started.
+            for target, future in conversions.items():
+                if not future.cancelled() and target != os.path.normcase(sources[target]):
+                    _removeFile(target)
+            _removeFile(partialPath)
         
-        print("\n[Done 6/6]\n")
-        sys.stdout.flush()
+        _progress("\n[Done 6/6]\n")
 
         print("creating " + outputFilePath + " was successful!")
 
 
+def _udtaDumpPath(stemFile):
+    # mp4box names the dump after the input file, without its extension
+    root, ext = os.path.splitext(stemFile)
+    return root + "_stem.udta"
+
+def _readStemMetadata(stemFile):
+    callArgs = [_mp4box]
+    callArgs.extend(["-dump-udta", "0:stem", stemFile])
+    subprocess.check_call(callArgs)
+
+    udtaFile = _udtaDumpPath(stemFile)
+    # The dumped box starts with an 8 byte header (size and type) before the JSON payload
+    with open(udtaFile, "rb") as fileObj:
+        fileObj.seek(8)
+        metadata = _loads(fileObj.read())
+    os.remove(udtaFile)
+    return metadata
+
+def _readStemMetadataGroup(stemFiles):
+    return [_readStemMetadata(stemFile) for stemFile in stemFiles]
+
 class StemMetadataViewer:
 
-    def __init__(self, stemFile):
-        self._metadata = {}
+    def __init__(self, stemFile, metadata = None):
+        if metadata is not None:
+            self._metadata = metadata
+        else:
+            self._metadata = _readStemMetadata(stemFile) if stemFile else {}
 
-        if stemFile:
-            folderName = "GPAC_win"   if _windows else "GPAC_mac"
-            executable = "mp4box.exe" if _windows else "MP4Box"
-            mp4box     = _findCmd(executable) if _linux else os.path.join(_getProgramPath(), folderName, executable)
+    @classmethod
+    def fromFiles(cls, stemFiles):
+        # Each file is dumped by its own mp4box process, so a whole library can be read in parallel. Files that
+        # share a dump path (e.g. "a.m4a" and "a.mp4") are read one after the other so that they do not overwrite
+        # each other's dump.
+        groups = {}
+        for stemFile in stemFiles:
+            groups.setdefault(os.path.normcase(os.path.abspath(_udtaDumpPath(stemFile))), []).append(stemFile)
 
-            callArgs = [mp4box]
-            callArgs.extend(["-dump-udta", "0:stem", stemFile])
-            subprocess.check_call(callArgs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            groupMetadata = executor.map(_readStemMetadataGroup, groups.values())
+            metadataByFile = {}
+            for group, metadataList in zip(groups.values(), groupMetadata):
+                metadataByFile.update(zip(group, metadataList))
 
-            root, ext = os.path.splitext(stemFile)
-            udtaFile = root + "_stem.udta"
-            fileObj = codecs.open(udtaFile, encoding="utf-8")
-            fileObj.seek(8)
-            self._metadata = json.load(fileObj)
-            os.remove(udtaFile)
+        return [cls(stemFile, metadata=metadataByFile[stemFile]) for stemFile in stemFiles]
 
     def dump(self, metadataFile = None, reportFile = None):
         if metadataFile:
-            fileObj = codecs.open(metadataFile, mode="w", encoding="utf-8")
-            try:
-                fileObj.write(json.dumps(self._metadata))
-            except Exception as e:
-                raise e
-            finally:
-                fileObj.close()
+            with open(metadataFile, "wb") as fileObj:
+                fileObj.write(_dumps(self._metadata))
 
         if reportFile:
-            fileObj = codecs.open(reportFile, mode="w", encoding="utf-8")
-            try:
-                for i, value in enumerate(self._metadata["stems"]):
-                    line = u"Track {:>3}      name: {:>15}     color: {:>8}\n".format(i + 1, value["name"], value["color"])
-                    fileObj.write(line)
-            except Exception as e:
-                raise e
-            finally:
-                fileObj.close()
+            formatLine = u"Track {:>3}      name: {:>15}     color: {:>8}\n".format
+            with open(reportFile, "w", encoding="utf-8") as fileObj:
+                fileObj.write("".join(formatLine(i + 1, value["name"], value["color"])
+                                      for i, value in enumerate(self._metadata["stems"])))